@@ -1,8 +1,11 @@
 # app.py
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
-import matplotlib.pyplot as plt
+import hashlib
+import re
+import altair as alt
 
 # ---------------- Page config ----------------
 st.set_page_config(page_title="Inventario Automatizado", page_icon="📦", layout="wide")
@@ -14,33 +17,258 @@ st.markdown(
 )
 
 # ---------------- Helpers: flexible detection ----------------
-def detectar_y_normalizar_columnas(df: pd.DataFrame):
-    posibles = {
-        'Producto': ['producto', 'artículo', 'articulo', 'nombre', 'item', 'descr', 'descripcion'],
-        'Categoría': ['categoria', 'categoría', 'tipo', 'clase', 'grupo', 'familia'],
-        'Proveedor': ['proveedor', 'supplier', 'vendor', 'distribuidor'],
-        'Stock': ['stock', 'existencias', 'cantidad', 'disponible', 'inventario', 'qty', 'unidades'],
-        'Precio Unitario (S/)': ['precio unitario', 'precio', 'costo', 'valor unitario', 'price', 'cost']
-    }
+POSIBLES = {
+    'Producto': ['producto', 'artículo', 'articulo', 'nombre', 'item', 'descr', 'descripcion'],
+    'Categoría': ['categoria', 'categoría', 'tipo', 'clase', 'grupo', 'familia'],
+    'Proveedor': ['proveedor', 'supplier', 'vendor', 'distribuidor'],
+    'Stock': ['stock', 'existencias', 'cantidad', 'disponible', 'inventario', 'qty', 'unidades'],
+    'Precio Unitario (S/)': ['precio unitario', 'precio', 'costo', 'valor unitario', 'price', 'cost']
+}
 
-    cols_map = {}
-    cols_lower = {c.lower().strip(): c for c in df.columns}
+# One precompiled alternation per standard
+PATRONES = {std: re.compile('|'.join(map(re.escape, syns))) for std, syns in POSIBLES.items()}
 
-    for standard, synonyms in posibles.items():
-        found = None
-        for syn in synonyms:
-            for col_lower, col_real in cols_lower.items():
-                if syn in col_lower:
-                    found = col_real
-                    break
-            if found:
-                cols_map[standard] = found
-                break
+def detectar_y_normalizar_columnas(df: pd.DataFrame):
+    best = {}  # standard -> (synonym rank, original column)
+    remaining = dict(PATRONES)  # standards that can still find a better column
+
+    for col_real in df.columns:
+        col_lower = str(col_real).lower().strip()
+        for standard, pattern in list(remaining.items()):
+            if pattern.search(col_lower):
+                # Earlier synonyms win regardless of column order
+                rank = next(i for i, syn in enumerate(POSIBLES[standard]) if syn in col_lower)
+                if standard not in best or rank < best[standard][0]:
+                    best[standard] = (rank, col_real)
+                if rank == 0:
+                    # First-choice synonym found: no later column can beat it
+                    del remaining[standard]
+        if not remaining:
+            break
+
+    cols_map = {std: best[std][1] for std in POSIBLES if std in best}
 
     ren = {orig: std for std, orig in cols_map.items()}
     df2 = df.rename(columns=ren)
     return df2, cols_map
 
+# ---------------- Cached loading ----------------
+REQUIRED = ['Producto', 'Stock', 'Precio Unitario (S/)']
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_inventory(file_key: str, _file_bytes: bytes):
+    # Cached per upload digest (the bytes themselves aren't hashed) and shared between
+    # reruns: treat the frame as read-only
+
+    # First sheet only
+    try:
+        df = pd.read_excel(io.BytesIO(_file_bytes), sheet_name=0, engine='calamine')
+    except Exception as err:
+        # Files calamine rejects are retried with pandas' default engine; if that fails
+        # too, calamine's own error is the one shown
+        try:
+            df = pd.read_excel(io.BytesIO(_file_bytes), sheet_name=0)
+        except Exception:
+            raise err
+
+    # Detect and rename flexible columns
+    df_work, detected = detectar_y_normalizar_columnas(df)
+    if any(r not in detected for r in REQUIRED):
+        return df_work, detected
+
+    # Numeric arrays, missing values as 0
+    stock = pd.to_numeric(df_work['Stock'], errors='coerce').to_numpy(np.float64, na_value=0.0)
+    price = pd.to_numeric(df_work['Precio Unitario (S/)'], errors='coerce').to_numpy(np.float64, na_value=0.0)
+
+    # Stock as int32 when whole and in range; money stays float64
+    if np.array_equal(stock, np.trunc(stock)) and np.abs(stock).max(initial=0) <= np.iinfo(np.int32).max:
+        df_work['Stock'] = stock.astype(np.int32)
+    else:
+        df_work['Stock'] = stock
+    df_work['Precio Unitario (S/)'] = price
+    df_work['Valor Total (S/)'] = np.multiply(stock, price)
+
+    # Product names as Arrow strings
+    df_work['Producto'] = df_work['Producto'].astype('string[pyarrow]')
+
+    # Low-cardinality labels as categoricals
+    for col in ('Categoría', 'Proveedor'):
+        if col in df_work.columns:
+            df_work[col] = df_work[col].astype('category')
+    return df_work, detected
+
+@st.cache_data(show_spinner=False)
+def pivot_inventory(file_key: str, _df_work: pd.DataFrame):
+    # Ignores the filters: built once per upload
+    if not {'Categoría', 'Proveedor'}.issubset(_df_work.columns):
+        return None
+    # Sum Valor Total per (category, provider) code pair; rows missing a label are skipped
+    cat = _df_work['Categoría'].cat
+    prov = _df_work['Proveedor'].cat
+    cat_codes = cat.codes.to_numpy()
+    prov_codes = prov.codes.to_numpy()
+    ok = (cat_codes >= 0) & (prov_codes >= 0)
+    n_cat, n_prov = len(cat.categories), len(prov.categories)
+    celdas = cat_codes[ok].astype(np.intp) * n_prov + prov_codes[ok]
+    size = n_cat * n_prov
+    sums = np.bincount(celdas, weights=_df_work['Valor Total (S/)'].to_numpy()[ok], minlength=size)
+    # Keep only categories/providers that occur together
+    seen = np.bincount(celdas, minlength=size).reshape(n_cat, n_prov) > 0
+    rows = seen.any(axis=1)
+    cols = seen.any(axis=0)
+    return pd.DataFrame(
+        sums.reshape(n_cat, n_prov)[np.ix_(rows, cols)],
+        index=pd.Index(cat.categories[rows], name='Categoría'),
+        columns=pd.Index(prov.categories[cols], name='Proveedor'),
+    )
+
+@st.cache_data(show_spinner=False)
+def resumir_inventario(file_key: str, _df_work: pd.DataFrame):
+    # Headline figures, once per upload
+    stock_np = _df_work['Stock'].to_numpy()
+    # A missing name (pd.NA in the Arrow column) is shown as a blank
+    producto_max, producto_min = (
+        '' if pd.isna(p) else p
+        for p in _df_work['Producto'].iloc[[int(stock_np.argmax()), int(stock_np.argmin())]]
+    )
+    return (
+        len(_df_work),
+        float(_df_work['Valor Total (S/)'].to_numpy().sum()),
+        float(_df_work['Precio Unitario (S/)'].to_numpy().mean()),
+        producto_max,
+        producto_min,
+    )
+
+# ---------------- Helpers: Excel export ----------------
+# Above this many rows the workbook is streamed with xlsxwriter's constant_memory mode
+FILAS_STREAMING = 20_000
+
+def celda_excel(v):
+    # Same cell values as to_excel: missing as blank, infinities as 'inf'/'-inf' text
+    if pd.isna(v):
+        return None
+    if isinstance(v, (float, np.floating)) and np.isinf(v):
+        return 'inf' if v > 0 else '-inf'
+    return v
+
+def escribir_filas(ws, df: pd.DataFrame, first_row: int):
+    # Row by row, as constant_memory mode requires
+    for r, fila in enumerate(df.itertuples(index=False, name=None), start=first_row):
+        ws.write_row(r, 0, [celda_excel(v) for v in fila])
+
+def filtrar_por_categoria(df_work: pd.DataFrame, selected_cats):
+    if selected_cats is None:
+        return df_work
+    mask = df_work['Categoría'].isin(selected_cats).to_numpy()
+    # All rows selected: reuse df_work
+    return df_work if mask.all() else df_work[mask]
+
+@st.cache_data(show_spinner=False)
+def agregar_por_producto(file_key: str, _df_work: pd.DataFrame, selected_cats):
+    # Per-product totals for both charts
+    df_filtered = filtrar_por_categoria(_df_work, selected_cats)
+    return df_filtered.groupby('Producto', sort=False, observed=True).agg(
+        {'Stock': 'sum', 'Valor Total (S/)': 'sum'}
+    )
+
+# Exports cache only the last few selections
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_csv(file_key: str, _df_work: pd.DataFrame, selected_cats) -> bytes:
+    # UTF-8 with BOM so Excel reads the accented headers
+    return filtrar_por_categoria(_df_work, selected_cats).to_csv(index=False).encode('utf-8-sig')
+
+@st.cache_data(show_spinner="Generando reporte Excel...", max_entries=4)
+def build_report(file_key: str, _df_work: pd.DataFrame, selected_cats) -> bytes:
+    # Cached per upload and category selection
+    total_productos, valor_total, precio_promedio, producto_max, producto_min = (
+        resumir_inventario(file_key, _df_work)
+    )
+    # Rows of the 'Reporte' sheet
+    resumen = (
+        ('Total de productos', total_productos),
+        ('Valor total del inventario (S/)', round(valor_total, 2)),
+        ('Precio promedio (S/)', round(precio_promedio, 2)),
+        ('Producto con mayor stock', producto_max),
+        ('Producto con menor stock', producto_min)
+    )
+    df_filtered = filtrar_por_categoria(_df_work, selected_cats)
+    pivot = pivot_inventory(file_key, _df_work)
+
+    streaming = len(df_filtered) > FILAS_STREAMING
+    opciones = {
+        'constant_memory': streaming,
+        # zip64 for very large streamed workbooks
+        'use_zip64': streaming,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+    }
+    with io.BytesIO() as buffer:
+        with pd.ExcelWriter(buffer, engine='xlsxwriter', engine_kwargs={'options': opciones}) as writer:
+            workbook = writer.book
+            title_fmt = workbook.add_format({'bold': True, 'font_size': 14, 'align': 'center'})
+            header_fmt = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+
+            # Sheet 1 (title first: streaming writes rows in order)
+            ws = workbook.add_worksheet('Inventario')
+            ws.merge_range(0, 0, 0, len(df_filtered.columns)-1,
+                           'REPORTE AUTOMATIZADO DE INVENTARIO', title_fmt)
+
+            header_row = 3
+            nrows = len(df_filtered)
+            ncols = len(df_filtered.columns)
+            last_row = header_row + nrows
+
+            if streaming:
+                # add_table() isn't supported in constant_memory mode; use a plain autofilter
+                ws.write_row(header_row, 0, list(df_filtered.columns), header_fmt)
+                escribir_filas(ws, df_filtered, header_row + 1)
+                ws.autofilter(header_row, 0, last_row, ncols-1)
+            else:
+                df_filtered.to_excel(writer, sheet_name='Inventario', index=False, startrow=header_row)
+                columns_table = [{'header': c} for c in df_filtered.columns]
+                ws.add_table(header_row, 0, last_row, ncols-1,
+                             {'columns': columns_table, 'style': 'Table Style Medium 9'})
+
+            # Column widths
+            ws.set_column(0, ncols-1, 25)
+
+            # Data range of every column, used by the charts
+            ranges = {c: ['Inventario', header_row+1, i, last_row, i]
+                      for i, c in enumerate(df_filtered.columns)}
+
+            # Chart 1
+            chart1 = workbook.add_chart({'type': 'column'})
+            chart1.add_series({'categories': ranges['Producto'], 'values': ranges['Stock']})
+            chart1.set_title({'name': 'Stock por Producto'})
+            ws.insert_chart('H5', chart1)
+
+            # Chart 2
+            chart2 = workbook.add_chart({'type': 'pie'})
+            chart2.add_series({'categories': ranges['Producto'], 'values': ranges['Valor Total (S/)']})
+            ws.insert_chart('H22', chart2)
+
+            # Sheet 2
+            ws2 = workbook.add_worksheet('Reporte')
+            ws2.merge_range(0, 0, 0, 1, 'REPORTE RESUMIDO DEL INVENTARIO', title_fmt)
+            # Row by row, as streaming mode requires
+            for r, fila in enumerate(resumen, start=3):
+                ws2.write_row(r, 0, [celda_excel(v) for v in fila])
+            ws2.set_column(0, 1, 40)
+
+            # Sheet 3
+            ws3 = workbook.add_worksheet('Resumen dinámico')
+            if pivot is not None:
+                ws3.merge_range(0, 0, 0, len(pivot.columns), 'TABLA DINÁMICA: VALOR TOTAL POR CATEGORÍA Y PROVEEDOR', title_fmt)
+                ws3.write_row(2, 0, [pivot.index.name] + list(pivot.columns), header_fmt)
+                escribir_filas(ws3, pivot.reset_index(), 3)
+                for i in range(len(pivot.columns)+1):
+                    ws3.set_column(i, i, 20)
+            else:
+                ws3.write(0, 0, 'No se pudo crear tabla dinámica.')
+
+        return buffer.getvalue()
+
 # ---------------- Sidebar / file uploader ----------------
 st.sidebar.header("⚙️ Configuración")
 st.sidebar.info("Sube un archivo Excel (.xlsx/.xls). "
@@ -51,14 +279,13 @@ archivo = st.sidebar.file_uploader("Selecciona el archivo Excel", type=["xlsx",
 # ---------------- Main processing ----------------
 if archivo:
     try:
-        df = pd.read_excel(archivo)
-
-        # Detect and rename flexible columns
-        df_norm, detected = detectar_y_normalizar_columnas(df)
+        file_bytes = archivo.getvalue()
+        # One digest per rerun keys every cached helper, so the upload is hashed only once
+        file_key = hashlib.sha256(file_bytes).hexdigest()
+        df_work, detected = load_inventory(file_key, file_bytes)
 
         # Required minimal
-        required = ['Producto', 'Stock', 'Precio Unitario (S/)']
-        missing_required = [r for r in required if r not in detected]
+        missing_required = [r for r in REQUIRED if r not in detected]
 
         if missing_required:
             st.error(
@@ -66,12 +293,6 @@ if archivo:
                 f"{', '.join(missing_required)}."
             )
         else:
-            df_work = df_norm.copy()
-            df_work['Stock'] = pd.to_numeric(df_work['Stock'], errors='coerce').fillna(0)
-            df_work['Precio Unitario (S/)'] = pd.to_numeric(df_work['Precio Unitario (S/)'], errors='coerce').fillna(0)
-
-            df_work['Valor Total (S/)'] = df_work['Stock'] * df_work['Precio Unitario (S/)']
-
             # Show detected mapping
             st.sidebar.subheader("Columnas detectadas")
             for std, orig in detected.items():
@@ -83,14 +304,9 @@ if archivo:
 
             # Summary metrics
             st.subheader("📊 Resumen general")
-            total_productos = len(df_work)
-            valor_total = df_work['Valor Total (S/)'].sum()
-            precio_promedio = df_work['Precio Unitario (S/)'].mean()
-
-            idx_max = df_work['Stock'].idxmax()
-            idx_min = df_work['Stock'].idxmin()
-            producto_max = df_work.loc[idx_max, 'Producto']
-            producto_min = df_work.loc[idx_min, 'Producto']
+            total_productos, valor_total, precio_promedio, producto_max, producto_min = (
+                resumir_inventario(file_key, df_work)
+            )
 
             c1, c2, c3 = st.columns(3)
             c1.metric("Total de productos", total_productos)
@@ -105,122 +321,67 @@ if archivo:
             st.sidebar.subheader("🔍 Filtros")
             if 'Categoría' in df_work.columns:
                 categorias = df_work['Categoría'].dropna().unique().tolist()
-                selected_cats = st.sidebar.multiselect("Filtrar por Categoría", categorias, default=categorias)
-                df_filtered = df_work[df_work['Categoría'].isin(selected_cats)]
+                selected_cats = tuple(st.sidebar.multiselect("Filtrar por Categoría", categorias, default=categorias))
             else:
-                df_filtered = df_work
+                selected_cats = None
 
             # Visualization
             st.subheader("📈 Visualizaciones")
             g1, g2 = st.columns(2)
 
+            por_producto = agregar_por_producto(file_key, df_work, selected_cats)
+
             with g1:
                 st.markdown("**📊 Stock por producto**")
-                series_stock = df_filtered.groupby('Producto')['Stock'].sum().sort_values(ascending=False)
+                series_stock = por_producto['Stock']
+                if len(series_stock) > 30:
+                    # Top 30 bars, the rest folded into 'Otros'
+                    top = series_stock.iloc[np.argpartition(-series_stock.to_numpy(), 30)[:30]]
+                    otros = pd.Series({'Otros': series_stock.sum() - top.sum()}, name='Stock')
+                    series_stock = pd.concat([top.sort_values(ascending=False), otros]).rename_axis('Producto')
+                else:
+                    series_stock = series_stock.sort_values(ascending=False)
                 st.bar_chart(series_stock)
 
             with g2:
                 st.markdown("**🥧 Torta: Producto vs Valor Total**")
-                series_val = df_filtered.groupby('Producto')['Valor Total (S/)'].sum().sort_values(ascending=False)
+                series_val = por_producto['Valor Total (S/)']
                 if len(series_val) > 20:
-                    series_val = series_val.nlargest(20)
-                fig, ax = plt.subplots(figsize=(5, 5))
-                ax.pie(series_val, labels=series_val.index, startangle=90)
-                ax.axis('equal')
-                st.pyplot(fig)
+                    # Top 20 only
+                    series_val = series_val.iloc[np.argpartition(-series_val.to_numpy(), 20)[:20]]
+                series_val = series_val.sort_values(ascending=False)
+                # Vega-Lite arc, rendered in the browser
+                pie_df = series_val.reset_index(name='Valor')
+                pie = alt.Chart(pie_df).mark_arc().encode(
+                    theta=alt.Theta('Valor:Q', stack=True),
+                    color=alt.Color('Producto:N', sort=None),
+                    order=alt.Order('Valor:Q', sort='descending'),
+                    tooltip=['Producto:N', alt.Tooltip('Valor:Q', format=',.2f')]
+                )
+                st.altair_chart(pie, use_container_width=True)
 
             # Pivot
             st.subheader("📊 Tabla dinámica")
-            if ('Categoría' in df_work.columns) and ('Proveedor' in df_work.columns):
-                pivot = pd.pivot_table(
-                    df_work,
-                    values='Valor Total (S/)',
-                    index='Categoría',
-                    columns='Proveedor',
-                    aggfunc='sum',
-                    fill_value=0
-                )
+            pivot = pivot_inventory(file_key, df_work)
+            if pivot is not None:
                 st.dataframe(pivot)
             else:
                 st.info("Faltan columnas para generar tabla dinámica.")
 
-            # ---------------- Excel export ----------------
-            st.subheader("💾 Generar reporte Excel (3 hojas)")
-            with io.BytesIO() as buffer:
-                with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                    workbook = writer.book
-
-                    # Sheet 1
-                    df_filtered.to_excel(writer, sheet_name='Inventario', index=False, startrow=3)
-                    ws = writer.sheets['Inventario']
-
-                    title_fmt = workbook.add_format({'bold': True, 'font_size': 14, 'align': 'center'})
-                    ws.merge_range(0, 0, 0, len(df_filtered.columns)-1,
-                                   'REPORTE AUTOMATIZADO DE INVENTARIO', title_fmt)
-
-                    # Autofilter
-                    header_row = 3
-                    nrows = len(df_filtered)
-                    ncols = len(df_filtered.columns)
-                    last_row = header_row + nrows
-
-                    columns_table = [{'header': c} for c in df_filtered.columns]
-                    ws.add_table(header_row, 0, last_row, ncols-1,
-                                 {'columns': columns_table, 'style': 'Table Style Medium 9'})
-
-                    # Column widths
-                    for i, col in enumerate(df_filtered.columns):
-                        ws.set_column(i, i, 25)
-
-                    col_idx = {c: i for i, c in enumerate(df_filtered.columns)}
-
-                    # Chart 1
-                    if 'Producto' in col_idx and 'Stock' in col_idx:
-                        chart1 = workbook.add_chart({'type': 'column'})
-                        chart1.add_series({
-                            'categories': ['Inventario', header_row+1, col_idx['Producto'], last_row, col_idx['Producto']],
-                            'values': ['Inventario', header_row+1, col_idx['Stock'], last_row, col_idx['Stock']],
-                        })
-                        chart1.set_title({'name': 'Stock por Producto'})
-                        ws.insert_chart('H5', chart1)
-
-                    # Chart 2
-                    if 'Producto' in col_idx and 'Valor Total (S/)' in col_idx:
-                        chart2 = workbook.add_chart({'type': 'pie'})
-                        chart2.add_series({
-                            'categories': ['Inventario', header_row+1, col_idx['Producto'], last_row, col_idx['Producto']],
-                            'values': ['Inventario', header_row+1, col_idx['Valor Total (S/)'], last_row, col_idx['Valor Total (S/)']],
-                        })
-                        ws.insert_chart('H22', chart2)
-
-                    # Sheet 2
-                    ws2 = workbook.add_worksheet('Reporte')
-                    ws2.merge_range(0, 0, 0, 1, 'REPORTE RESUMIDO DEL INVENTARIO', title_fmt)
-                    resumen = [
-                        ['Total de productos', total_productos],
-                        ['Valor total del inventario (S/)', round(valor_total, 2)],
-                        ['Precio promedio (S/)', round(precio_promedio, 2)],
-                        ['Producto con mayor stock', producto_max],
-                        ['Producto con menor stock', producto_min]
-                    ]
-                    ws2.write_column(3, 0, [r[0] for r in resumen])
-                    ws2.write_column(3, 1, [r[1] for r in resumen])
-                    ws2.set_column(0, 1, 40)
-
-                    # Sheet 3
-                    ws3 = workbook.add_worksheet('Resumen dinámico')
-                    if ('Categoría' in df_work.columns) and ('Proveedor' in df_work.columns):
-                        pivot.to_excel(writer, sheet_name='Resumen dinámico', startrow=2)
-                        ws3.merge_range(0, 0, 0, len(pivot.columns), 'TABLA DINÁMICA: VALOR TOTAL POR CATEGORÍA Y PROVEEDOR', title_fmt)
-                        for i in range(len(pivot.columns)+1):
-                            ws3.set_column(i, i, 20)
-                    else:
-                        ws3.write(0, 0, 'No se pudo crear tabla dinámica.')
-
-                buffer.seek(0)
+            # ---------------- Export ----------------
+            st.subheader("💾 Descargar reporte")
+            st.download_button(
+                label="📥 Descargar Inventario (CSV)",
+                data=build_csv(file_key, df_work, selected_cats),
+                file_name="Reporte_Inventario.csv",
+                mime="text/csv"
+            )
+
+            # Excel workbook only on request
+            if st.checkbox("Incluir formato Excel (3 hojas)"):
                 st.download_button(
                     label="📥 Descargar Reporte Excel Completo",
-                    data=buffer,
+                    data=build_report(file_key, df_work, selected_cats),
                     file_name="Reporte_Inventario_Completo.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )